@@ -9,15 +9,44 @@ Created on Thu Jul 25 13:23:15 2019
 from __future__ import print_function
 from __future__ import division
 
+import importlib
+import inspect
 import numpy as np
-import pymc3 as pm
-import theano
+try:
+    import pymc3 as pm
+    import theano
+    # keyword for the starting value of a random variable; renamed in v4
+    initval_kwarg = 'testval'
+except ImportError:  # pymc3/theano were renamed pymc/pytensor from v4 on
+    import pymc as pm
+    import pytensor as theano
+    # pytensor can JIT the compiled graphs with numba instead of the C
+    # backend, which removes the compiler round-trip per graph.
+    theano.config.mode = 'NUMBA'
+    initval_kwarg = 'initval'
 from itertools import product
 from functools import reduce
 from scipy import stats
+from scipy.special import expit
 import bspline
 from bspline import splinelab
 
+try:  # numba is optional and only accelerates the predictive reductions
+    from numba import njit, prange
+    have_numba = True
+except ImportError:
+    have_numba = False
+
+# Compiled theano functions re-validate their input types on every call,
+# which adds python overhead to each leapfrog step of NUTS. The sampler
+# always feeds arrays of the right dtype/shape, so the checks are skipped.
+theano.config.check_input = False
+
+# Keep the intermediate buffers of the compiled graph alive between calls;
+# the leapfrog loop re-evaluates the same graph thousands of times and
+# re-allocating the intermediates each call costs more than the memory.
+theano.config.allow_gc = False
+
 
 
 def bspline_fit(X, order, nknots):
@@ -56,10 +85,14 @@ def create_poly_basis(X, order):
     D = X.shape[1]
     Phi = np.zeros((X.shape[0], D*order))
     colid = np.arange(0, D)
+    # Build the powers Horner-style with a running product: one multiply
+    # per degree instead of a full exponentiation per column block.
+    Xpow = np.ones_like(X, dtype=Phi.dtype)
     for d in range(1, order+1):
-        Phi[:, colid] = X ** d
+        Xpow = Xpow * X
+        Phi[:, colid] = Xpow
         colid += D
-        
+
     return Phi
 
 
@@ -123,81 +156,328 @@ def from_posterior(param, samples, distribution=None, half=False, freedom=1):
             return pm.Uniform(param, lower=0, upper=upper_bound + freedom*r, shape=shape)
     
 
-def hbr(X, y, batch_effects, batch_effects_size, configs, trace=None):
-    
-    feature_num = X.shape[1]
-    y_shape = y.shape
+def batch_idx(batch_effects):
+    """ precompute the row indices of every batch-effect combination. The
+    unique values and boolean masks are computed once per dataset instead of
+    once per assignment loop during graph assembly; combinations without
+    observations are dropped """
+
     batch_effects_num = batch_effects.shape[1]
     all_idx = []
     for i in range(batch_effects_num):
-        all_idx.append(np.int16(np.unique(batch_effects[:,i])))
-    be_idx = list(product(*all_idx))
-    
-    X = theano.shared(X)
-    y = theano.shared(y)
-    
+        all_idx.append(np.int32(np.unique(batch_effects[:,i])))
+
+    be_idx = []
+    for be in product(*all_idx):
+        a = []
+        for i, b in enumerate(be):
+            a.append(batch_effects[:,i]==b)
+        # int32 indices take theano's native integer-indexing path, avoiding
+        # the int64 casts set_subtensor otherwise inserts into the graph
+        idx = np.int32(reduce(np.logical_and, a).nonzero()[0])
+        if idx.shape[0] != 0:
+            be_idx.append((be, idx))
+
+    return be_idx
+
+
+def sample_ppc(trace, samples, progressbar=True):
+    """ draw posterior predictive samples of y_like, using the vectorized
+    implementation when the installed pymc3 provides it. The vectorized
+    version broadcasts over all trace points in a single pass instead of
+    sampling them one by one """
+
+    if isinstance(trace, dict):
+        # a flat per-variable mapping (e.g. from the numpyro backend); turn
+        # it into the list of points the pymc3 samplers accept
+        names = list(trace)
+        trace = [{name: trace[name][s] for name in names}
+                 for s in range(trace[names[0]].shape[0])]
+    if hasattr(pm, 'fast_sample_posterior_predictive'):
+        return pm.fast_sample_posterior_predictive(trace, samples=samples,
+                                                   var_names=['y_like'])
+    return pm.sample_posterior_predictive(trace, samples=samples,
+                                          progressbar=progressbar)
+
+
+if have_numba:
+    @njit(parallel=True, cache=True)
+    def moments_jit(like):
+        """ single-pass mean/variance over the sample axis, parallelized
+        across the prediction columns """
+
+        sample_num, col_num = like.shape
+        mean = np.zeros(col_num)
+        var = np.zeros(col_num)
+        for m in prange(col_num):
+            acc = 0.0
+            for s in range(sample_num):
+                acc += like[s, m]
+            mu = acc / sample_num
+            acc2 = 0.0
+            for s in range(sample_num):
+                d = like[s, m] - mu
+                acc2 += d * d
+            mean[m] = mu
+            var[m] = acc2 / sample_num
+        return mean, var
+
+
+def ppc_moments(like):
+    """ compute the predictive mean and variance of posterior predictive
+    draws, reusing the draws buffer for the squared deviations instead of
+    allocating mean/var temporaries over the full (samples, N) array. With
+    numba installed the reduction runs as a parallel jitted kernel """
+
+    if have_numba:
+        flat = np.ascontiguousarray(like.reshape(like.shape[0], -1),
+                                    dtype=np.float64)
+        pred_mean, pred_var = moments_jit(flat)
+        return (pred_mean.reshape(like.shape[1:]),
+                pred_var.reshape(like.shape[1:]))
+
+    pred_mean = like.mean(axis=0)
+    np.subtract(like, pred_mean, out=like)
+    np.square(like, out=like)
+    pred_var = like.mean(axis=0)
+
+    return pred_mean, pred_var
+
+
+def hbr_moments(X, batch_effects, configs, trace):
+    """ compute the predictive mean and variance of an estimated hbr model
+    directly from the trace, broadcasting over all posterior samples at once
+    instead of drawing them one by one """
+
+    sample_num = trace['mu_prior_intercept'].shape[0]
+    response_num = trace['mu_prior_intercept'].shape[-1]
+    batch_effects_num = batch_effects.shape[1]
+    be_idx = batch_idx(batch_effects)
+
+    def expand(prior, grouped):
+        """ align a population prior (samples x ...) with the batch-effect
+        axes of the sampled offsets """
+        if not grouped:
+            return prior
+        return prior.reshape(prior.shape[:1] + (1,) * batch_effects_num +
+                             prior.shape[1:])
+
+    # The group-level parameters are no longer stored in the trace; rebuild
+    # them from the sampled offsets, which is a cheap broadcast.
+    intercepts = (expand(trace['mu_prior_intercept'],
+                         configs['random_intercept']) +
+                  trace['intercepts_offset'] *
+                  np.exp(expand(trace['log_sigma_prior_intercept'],
+                                configs['random_intercept'])))
+    slopes = (expand(trace['mu_prior_slope'], configs['random_slope']) +
+              trace['slopes_offset'] *
+              np.exp(expand(trace['log_sigma_prior_slope'],
+                            configs['random_slope'])))
+    if configs['random_noise'] and configs['hetero_noise']:
+        intercepts_noise = (expand(trace['mu_prior_intercept_noise'],
+                                   configs['random_intercept']) +
+                            trace['intercepts_noise_offset'] *
+                            np.exp(expand(trace['log_sigma_prior_intercept_noise'],
+                                          configs['random_intercept'])))
+        slopes_noise = (expand(trace['mu_prior_slope_noise'],
+                               configs['random_slope']) +
+                        trace['slopes_noise_offset'] *
+                        np.exp(expand(trace['log_sigma_prior_slope_noise'],
+                                      configs['random_slope'])))
+
+    mu = np.zeros((sample_num, X.shape[0], response_num))
+    s2 = np.zeros((sample_num, X.shape[0], response_num))
+    for be, idx in be_idx:
+        if configs['random_intercept']:
+            temp_intercepts = intercepts[(slice(None),) + be]
+        else:
+            temp_intercepts = intercepts
+        if configs['random_slope']:
+            temp_slopes = slopes[(slice(None),) + be]
+        else:
+            temp_slopes = slopes
+        mu[:,idx,:] = (temp_intercepts[:,np.newaxis,:] +
+                       np.einsum('nf,sfr->snr', X[idx,:], temp_slopes))
+
+        if configs['random_noise']:
+            if configs['hetero_noise']:
+                if configs['random_intercept']:
+                    temp_intercepts_noise = intercepts_noise[(slice(None),) + be]
+                else:
+                    temp_intercepts_noise = intercepts_noise
+                if configs['random_slope']:
+                    temp_slopes_noise = slopes_noise[(slice(None),) + be]
+                else:
+                    temp_slopes_noise = slopes_noise
+                sigma_y = np.logaddexp(0, temp_intercepts_noise[:,np.newaxis,:] +
+                                       np.einsum('nf,sfr->snr', X[idx,:],
+                                                 temp_slopes_noise)) + 1e-5
+            else:
+                sigma_y = np.exp(trace['log_sigma_noise'][(slice(None),) + be])[:,np.newaxis,:]
+        else:
+            sigma_y = np.exp(trace['log_sigma_noise'])[:,np.newaxis,:]
+        s2[:,idx,:] = sigma_y ** 2
+
+    pred_mean = mu.mean(axis=0)
+    pred_var = mu.var(axis=0) + s2.mean(axis=0)
+
+    return pred_mean, pred_var
+
+
+def nn_hbr_moments(X, batch_effects, configs, trace):
+    """ compute the predictive mean and variance of an estimated nn_hbr model
+    directly from the trace. The per-group sub-network is evaluated for all
+    posterior samples in one batched pass over the sample axis instead of
+    rebuilding the sub-expressions per trace point """
+
+    n_layers = configs['nn_hidden_layers_num']
+    sample_num = trace['w_in_1_grp'].shape[0]
+    batch_effects_num = batch_effects.shape[1]
+    be_idx = batch_idx(batch_effects)
+
+    # The per-group intercepts are not stored in the trace; rebuild them
+    # from the sampled offsets and the scalar population prior.
+    prior_shape = (-1,) + (1,) * batch_effects_num
+    intercepts = (trace['mu_prior_intercept'].reshape(prior_shape) +
+                  trace['intercepts_offset'] *
+                  trace['sigma_prior_intercept'].reshape(prior_shape))
+
+    mu = np.zeros((sample_num, X.shape[0]))
+    s2 = np.zeros((sample_num, X.shape[0]))
+    for be, idx in be_idx:
+        sl = (slice(None),) + be
+        weights_in_1 = (trace['w_in_1'][sl] * trace['w_in_1_grp_sd'] +
+                        trace['w_in_1_grp'])
+        act = np.tanh(np.einsum('nf,sfh->snh', X[idx,:], weights_in_1))
+        if n_layers == 2:
+            weights_1_2 = (trace['w_1_2'][sl] * trace['w_1_2_grp_sd'] +
+                           trace['w_1_2_grp'])
+            act = np.tanh(np.einsum('snh,shk->snk', act, weights_1_2))
+        weights_2_out = (trace['w_2_out'][sl] * trace['w_2_out_grp_sd'] +
+                         trace['w_2_out_grp'])
+        mu[:,idx] = (intercepts[sl][:,np.newaxis] +
+                     np.einsum('snh,sh->sn', act, weights_2_out))
+
+        if configs['random_noise']:
+            if configs['hetero_noise']:
+                weights_in_1_noise = (trace['w_in_1_noise'][sl] *
+                                      trace['w_in_1_grp_sd_noise'] +
+                                      trace['w_in_1_grp_noise'])
+                act_noise = expit(np.einsum('nf,sfh->snh', X[idx,:],
+                                            weights_in_1_noise))
+                if n_layers == 2:
+                    weights_1_2_noise = (trace['w_1_2_noise'][sl] *
+                                         trace['w_1_2_grp_sd_noise'] +
+                                         trace['w_1_2_grp_noise'])
+                    act_noise = expit(np.einsum('snh,shk->snk', act_noise,
+                                                weights_1_2_noise))
+                weights_2_out_noise = (trace['w_2_out_noise'][sl] *
+                                       trace['w_2_out_grp_sd_noise'] +
+                                       trace['w_2_out_grp_noise'])
+                sigma_y = np.logaddexp(0, np.einsum('snh,sh->sn', act_noise,
+                                                    weights_2_out_noise)) + 1e-5
+            else:
+                sigma_y = trace['sigma_noise'][sl][:,np.newaxis]
+        else:
+            sigma_y = trace['sigma_noise'][:,np.newaxis]
+        s2[:,idx] = sigma_y ** 2
+
+    pred_mean = mu.mean(axis=0)[:,np.newaxis]
+    pred_var = (mu.var(axis=0) + s2.mean(axis=0))[:,np.newaxis]
+
+    return pred_mean, pred_var
+
+
+def hbr(X, y, batch_effects, batch_effects_size, configs, trace=None,
+        shared=True):
+
+    feature_num = X.shape[1]
+    y_shape = y.shape
+    # The responses may carry a second (e.g., voxel) dimension; all random
+    # variables get a trailing axis of this size so a single NUTS run fits
+    # all response columns jointly and the compile cost is paid only once.
+    response_num = y_shape[1]
+    be_idx = batch_idx(batch_effects)
+
+    # Shared variables allow swapping the data without recompiling the graph,
+    # but sampling from the posterior predictive is much slower on shared
+    # inputs, so one-shot graphs are built on constant data instead.
+    # Cast to theano's configured float width so the graph stays in floatX
+    # throughout (enables float32/GPU and single-precision BLAS kernels).
+    X = pm.floatX(X)
+    y = pm.floatX(y)
+
     with pm.Model() as model:
+        # pm.Data registers the containers by name so get_model can refresh
+        # them through pm.set_data without touching the compiled graph.
+        if shared:
+            X = pm.Data('X', X)
+            y = pm.Data('y', y)
         # Priors
         if trace is not None: # Used for transferring the priors
-            mu_prior_intercept = from_posterior('mu_prior_intercept', 
-                                                    trace['mu_prior_intercept'], 
+            mu_prior_intercept = from_posterior('mu_prior_intercept',
+                                                    trace['mu_prior_intercept'],
                                                     distribution='normal', freedom=configs['freedom'])
-            log_sigma_prior_intercept = from_posterior('log_sigma_prior_intercept', 
-                                               trace['log_sigma_prior_intercept'], freedom=configs['freedom'], 
+            log_sigma_prior_intercept = from_posterior('log_sigma_prior_intercept',
+                                               trace['log_sigma_prior_intercept'], freedom=configs['freedom'],
                                                distribution='normal')
-            mu_prior_slope = from_posterior('mu_prior_slope', 
-                                            trace['mu_prior_slope'], 
+            mu_prior_slope = from_posterior('mu_prior_slope',
+                                            trace['mu_prior_slope'],
                                             distribution='normal', freedom=configs['freedom'])
-            log_sigma_prior_slope = from_posterior('log_sigma_prior_slope', 
-                                               trace['log_sigma_prior_slope'], 
+            log_sigma_prior_slope = from_posterior('log_sigma_prior_slope',
+                                               trace['log_sigma_prior_slope'],
                                                distribution='normal', freedom=configs['freedom'])
         else:
-            mu_prior_intercept = pm.Normal('mu_prior_intercept', mu=0., sigma=1e3)
-            log_sigma_prior_intercept = pm.Normal('log_sigma_prior_intercept', mu=0., sigma=2.5)
-            mu_prior_slope = pm.Normal('mu_prior_slope', mu=0., sigma=1e3, shape=(feature_num,))
-            log_sigma_prior_slope = pm.Normal('log_sigma_prior_slope', mu=0., sigma=2.5, shape=(feature_num,))
-        
-        if configs['random_intercept']: 
-            intercepts_offset = pm.Normal('intercepts_offset', mu=0, sd=1, 
-                                          shape=(batch_effects_size))
+            mu_prior_intercept = pm.Normal('mu_prior_intercept', mu=0., sigma=1e3,
+                                           shape=(response_num,))
+            log_sigma_prior_intercept = pm.Normal('log_sigma_prior_intercept', mu=0., sigma=2.5,
+                                                  shape=(response_num,))
+            mu_prior_slope = pm.Normal('mu_prior_slope', mu=0., sigma=1e3,
+                                       shape=(feature_num, response_num))
+            log_sigma_prior_slope = pm.Normal('log_sigma_prior_slope', mu=0., sigma=2.5,
+                                              shape=(feature_num, response_num))
+
+        if configs['random_intercept']:
+            intercepts_offset = pm.Normal('intercepts_offset', mu=0, sigma=1,
+                                          shape=(batch_effects_size + [response_num]))
         else:
-            intercepts_offset = pm.Normal('intercepts_offset', mu=0, sd=1)
-       
-        intercepts = pm.Deterministic('intercepts', mu_prior_intercept + 
-                                      intercepts_offset * pm.math.exp(log_sigma_prior_intercept))
-        
+            intercepts_offset = pm.Normal('intercepts_offset', mu=0, sigma=1,
+                                          shape=(response_num,))
+
+        # Plain expressions rather than pm.Deterministic: storing the
+        # group-level parameters alongside the offsets doubles the trace
+        # size for nothing, since the moment helpers can rebuild them.
+        intercepts = (mu_prior_intercept +
+                      intercepts_offset * pm.math.exp(log_sigma_prior_intercept))
+
         if configs['random_slope']:  # Random slopes
-            slopes_offset = pm.Normal('slopes_offset', mu=0, sd=1, 
-                                     shape=(batch_effects_size + [feature_num]))
+            slopes_offset = pm.Normal('slopes_offset', mu=0, sigma=1,
+                                     shape=(batch_effects_size + [feature_num, response_num]))
         else:
-            slopes_offset = pm.Normal('slopes_offset', mu=0, sd=1)
-            
-        slopes = pm.Deterministic('slopes', mu_prior_slope + 
-                                          slopes_offset * pm.math.exp(log_sigma_prior_slope))
-        
+            slopes_offset = pm.Normal('slopes_offset', mu=0, sigma=1,
+                                      shape=(feature_num, response_num))
+
+        slopes = (mu_prior_slope +
+                  slopes_offset * pm.math.exp(log_sigma_prior_slope))
+
         y_hat = theano.tensor.zeros(y_shape)
-        for be in be_idx:
-            a = []
-            for i, b in enumerate(be):
-                a.append(batch_effects[:,i]==b) 
-            idx = reduce(np.logical_and, a).nonzero()
-            if idx[0].shape[0] != 0:
-                if (not configs['random_intercept'] and not configs['random_slope']):
-                    y_hat = theano.tensor.set_subtensor(y_hat[idx,0], 
-                                        intercepts + theano.tensor.dot(X[idx,:], 
-                                                                       slopes))
-                elif (configs['random_intercept'] and not configs['random_slope']):
-                    y_hat = theano.tensor.set_subtensor(y_hat[idx,0], 
-                                    intercepts[be] + theano.tensor.dot(X[idx,:],
-                                              slopes))
-                elif (not configs['random_intercept'] and configs['random_slope']):
-                    y_hat = theano.tensor.set_subtensor(y_hat[idx,0], 
-                                    intercepts + theano.tensor.dot(X[idx,:], 
-                                                                   slopes[be]))
-                elif (configs['random_intercept'] and configs['random_slope']):        
-                    y_hat = theano.tensor.set_subtensor(y_hat[idx,0], 
-                                    intercepts[be] + theano.tensor.dot(X[idx,:], 
-                                              slopes[be]))
+        for be, idx in be_idx:
+            if (not configs['random_intercept'] and not configs['random_slope']):
+                y_hat = theano.tensor.set_subtensor(y_hat[idx],
+                                    intercepts + theano.tensor.dot(X[idx,:],
+                                                                   slopes))
+            elif (configs['random_intercept'] and not configs['random_slope']):
+                y_hat = theano.tensor.set_subtensor(y_hat[idx],
+                                intercepts[be] + theano.tensor.dot(X[idx,:],
+                                          slopes))
+            elif (not configs['random_intercept'] and configs['random_slope']):
+                y_hat = theano.tensor.set_subtensor(y_hat[idx],
+                                intercepts + theano.tensor.dot(X[idx,:],
+                                                               slopes[be]))
+            elif (configs['random_intercept'] and configs['random_slope']):
+                y_hat = theano.tensor.set_subtensor(y_hat[idx],
+                                intercepts[be] + theano.tensor.dot(X[idx,:],
+                                          slopes[be]))
         
         if configs['random_noise']:
             if configs['hetero_noise']:
@@ -216,57 +496,53 @@ def hbr(X, y, batch_effects, batch_effects_size, configs, trace=None):
                                                        trace['log_sigma_prior_slope_noise'], 
                                                        distribution='normal', freedom=configs['freedom'])
                 else:
-                    mu_prior_intercept_noise = pm.HalfNormal('mu_prior_intercept_noise', 
-                                                             sigma=1e3)
-                    log_sigma_prior_intercept_noise = pm.Normal('log_sigma_prior_intercept_noise', mu=0., sigma=2.5)
-                    mu_prior_slope_noise = pm.Normal('mu_prior_slope_noise',  mu=0., 
-                                                     sigma=1e3, shape=(feature_num,))
-                    log_sigma_prior_slope_noise = pm.Normal('log_sigma_prior_slope_noise', 
-                                                            mu=0., sigma=2.5, shape=(feature_num,))
-                if configs['random_intercept']: 
+                    mu_prior_intercept_noise = pm.HalfNormal('mu_prior_intercept_noise',
+                                                             sigma=1e3, shape=(response_num,))
+                    log_sigma_prior_intercept_noise = pm.Normal('log_sigma_prior_intercept_noise', mu=0., sigma=2.5,
+                                                                shape=(response_num,))
+                    mu_prior_slope_noise = pm.Normal('mu_prior_slope_noise',  mu=0.,
+                                                     sigma=1e3, shape=(feature_num, response_num))
+                    log_sigma_prior_slope_noise = pm.Normal('log_sigma_prior_slope_noise',
+                                                            mu=0., sigma=2.5, shape=(feature_num, response_num))
+                if configs['random_intercept']:
                     intercepts_noise_offset = pm.Normal('intercepts_noise_offset',
-                                                        sd=1, shape=(batch_effects_size))
+                                                        sigma=1, shape=(batch_effects_size + [response_num]))
                 else:
                     intercepts_noise_offset = pm.Normal('intercepts_noise_offset',
-                                                                    sd=1)
-                    
-                intercepts_noise = pm.Deterministic('intercepts_noise',
-                                                    mu_prior_intercept_noise + 
-                                                    intercepts_noise_offset * 
-                                                    pm.math.exp(log_sigma_prior_intercept_noise))
+                                                        sigma=1, shape=(response_num,))
+
+                intercepts_noise = (mu_prior_intercept_noise +
+                                    intercepts_noise_offset *
+                                    pm.math.exp(log_sigma_prior_intercept_noise))
     
                 if configs['random_slope']:
-                    slopes_noise_offset = pm.Normal('slopes_noise_offset', mu=0, sd=1, 
-                                     shape=(batch_effects_size + [feature_num]))
+                    slopes_noise_offset = pm.Normal('slopes_noise_offset', mu=0, sigma=1,
+                                     shape=(batch_effects_size + [feature_num, response_num]))
                 else:
-                    slopes_noise_offset = pm.Normal('slopes_noise_offset', mu=0, sd=1)
-                    
-                slopes_noise = pm.Deterministic('slopes_noise', mu_prior_slope_noise + 
-                                          slopes_noise_offset * pm.math.exp(log_sigma_prior_slope_noise))
+                    slopes_noise_offset = pm.Normal('slopes_noise_offset', mu=0, sigma=1,
+                                                    shape=(feature_num, response_num))
+
+                slopes_noise = (mu_prior_slope_noise +
+                                slopes_noise_offset * pm.math.exp(log_sigma_prior_slope_noise))
                 
                 sigma_noise = theano.tensor.zeros(y_shape)
-                for be in be_idx:
-                    a = []
-                    for i, b in enumerate(be):
-                        a.append(batch_effects[:,i]==b)        
-                    idx = reduce(np.logical_and, a).nonzero()
-                    if idx[0].shape[0]!=0:
-                        if (not configs['random_intercept'] and not configs['random_slope']):
-                            sigma_noise = theano.tensor.set_subtensor(sigma_noise[idx,0], 
-                                                   intercepts_noise + theano.tensor.dot(X[idx,:], 
-                                                                   slopes_noise))
-                        elif (configs['random_intercept'] and not configs['random_slope']):
-                            sigma_noise = theano.tensor.set_subtensor(sigma_noise[idx,0], 
-                                                   intercepts_noise[be] + theano.tensor.dot(X[idx,:], 
-                                                                   slopes_noise))
-                        elif (not configs['random_intercept'] and configs['random_slope']):
-                            sigma_noise = theano.tensor.set_subtensor(sigma_noise[idx,0], 
-                                                   intercepts_noise + theano.tensor.dot(X[idx,:], 
-                                                                   slopes_noise[be]))
-                        elif (configs['random_intercept'] and configs['random_slope']):        
-                            sigma_noise = theano.tensor.set_subtensor(sigma_noise[idx,0], 
-                                                   intercepts_noise[be] + theano.tensor.dot(X[idx,:], 
-                                                                   slopes_noise[be]))
+                for be, idx in be_idx:
+                    if (not configs['random_intercept'] and not configs['random_slope']):
+                        sigma_noise = theano.tensor.set_subtensor(sigma_noise[idx],
+                                               intercepts_noise + theano.tensor.dot(X[idx,:],
+                                                               slopes_noise))
+                    elif (configs['random_intercept'] and not configs['random_slope']):
+                        sigma_noise = theano.tensor.set_subtensor(sigma_noise[idx],
+                                               intercepts_noise[be] + theano.tensor.dot(X[idx,:],
+                                                               slopes_noise))
+                    elif (not configs['random_intercept'] and configs['random_slope']):
+                        sigma_noise = theano.tensor.set_subtensor(sigma_noise[idx],
+                                               intercepts_noise + theano.tensor.dot(X[idx,:],
+                                                               slopes_noise[be]))
+                    elif (configs['random_intercept'] and configs['random_slope']):
+                        sigma_noise = theano.tensor.set_subtensor(sigma_noise[idx],
+                                               intercepts_noise[be] + theano.tensor.dot(X[idx,:],
+                                                               slopes_noise[be]))
                               
                 sigma_y = pm.math.log1pexp(sigma_noise) + 1e-5
                         
@@ -278,45 +554,32 @@ def hbr(X, y, batch_effects, batch_effects_size, configs, trace=None):
                                                     
                 else:
                     #log_sigma_noise = pm.Uniform('log_sigma_noise', lower=-5, upper=5, shape=(batch_effects_size))
-                    log_sigma_noise = pm.Normal('log_sigma_noise', mu=0., sigma=2.5, shape=(batch_effects_size))
+                    log_sigma_noise = pm.Normal('log_sigma_noise', mu=0., sigma=2.5,
+                                                shape=(batch_effects_size + [response_num]))
                 sigma_y = theano.tensor.zeros(y_shape)
-                for be in be_idx:
-                    a = []
-                    for i, b in enumerate(be):
-                        a.append(batch_effects[:,i]==b)             
-                    idx = reduce(np.logical_and, a).nonzero()
-                    if idx[0].shape[0]!=0:
-                        sigma_y = theano.tensor.set_subtensor(sigma_y[idx,0], pm.math.exp(log_sigma_noise[be]))
-        
+                for be, idx in be_idx:
+                    sigma_y = theano.tensor.set_subtensor(sigma_y[idx], pm.math.exp(log_sigma_noise[be]))
+
         else:
-            if trace is not None: 
-                log_sigma_noise = from_posterior('log_sigma_noise', 
-                                               trace['log_sigma_noise'], 
+            if trace is not None:
+                log_sigma_noise = from_posterior('log_sigma_noise',
+                                               trace['log_sigma_noise'],
                                                distribution='normal', freedom=configs['freedom'])
             else:
                 #log_sigma_noise = pm.Uniform('log_sigma_noise', lower=-5, upper=5)
-                log_sigma_noise = pm.Normal('log_sigma_noise', mu=0., sigma=2.5)
-                
+                log_sigma_noise = pm.Normal('log_sigma_noise', mu=0., sigma=2.5,
+                                            shape=(response_num,))
+
             sigma_y = theano.tensor.zeros(y_shape)
-            for be in be_idx:
-                a = []
-                for i, b in enumerate(be):
-                    a.append(batch_effects[:,i]==b)
-                    
-                idx = reduce(np.logical_and, a).nonzero()
-                if idx[0].shape[0]!=0:
-                    sigma_y = theano.tensor.set_subtensor(sigma_y[idx,0], pm.math.exp(log_sigma_noise))
-            
+            for be, idx in be_idx:
+                sigma_y = theano.tensor.set_subtensor(sigma_y[idx], pm.math.exp(log_sigma_noise))
+
         if configs['skewed_likelihood']:
-            skewness = pm.Uniform('skewness', lower=-10, upper=10, shape=(batch_effects_size))
+            skewness = pm.Uniform('skewness', lower=-10, upper=10,
+                                  shape=(batch_effects_size + [response_num]))
             alpha = theano.tensor.zeros(y_shape)
-            for be in be_idx:
-                a = []
-                for i, b in enumerate(be):
-                    a.append(batch_effects[:,i]==b)             
-                idx = reduce(np.logical_and, a).nonzero()
-                if idx[0].shape[0]!=0:
-                    alpha = theano.tensor.set_subtensor(alpha[idx,0], skewness[be])
+            for be, idx in be_idx:
+                alpha = theano.tensor.set_subtensor(alpha[idx], skewness[be])
         else:
             alpha = 0
         
@@ -325,20 +588,20 @@ def hbr(X, y, batch_effects, batch_effects_size, configs, trace=None):
     return model
 
 
-def nn_hbr(X, y, batch_effects, batch_effects_size, configs, trace=None):
-    
+def nn_hbr(X, y, batch_effects, batch_effects_size, configs, trace=None,
+           shared=True):
+
     n_hidden = configs['nn_hidden_neuron_num']
     n_layers = configs['nn_hidden_layers_num']
     feature_num = X.shape[1]
-    batch_effects_num = batch_effects.shape[1]
-    all_idx = []
-    for i in range(batch_effects_num):
-        all_idx.append(np.int16(np.unique(batch_effects[:,i])))
-    be_idx = list(product(*all_idx))
-        
-    X = theano.shared(X)
-    y = theano.shared(y)
-    
+    y_shape = y.shape
+    be_idx = batch_idx(batch_effects)
+
+    # Cast to theano's configured float width so the graph stays in floatX
+    # throughout, also when X and y end up as constants (shared=False).
+    X = pm.floatX(X)
+    y = pm.floatX(y)
+
     # Initialize random weights between each layer for the mu:
     init_1 = pm.floatX(np.random.randn(feature_num, n_hidden) * np.sqrt(1/feature_num))
     init_out = pm.floatX(np.random.randn(n_hidden) * np.sqrt(1/n_hidden)) 
@@ -361,98 +624,96 @@ def nn_hbr(X, y, batch_effects, batch_effects_size, configs, trace=None):
         std_init_2_noise = pm.floatX(np.random.rand(n_hidden, n_hidden))
     
     with pm.Model() as model:
+        if shared:
+            X = pm.Data('X', X)
+            y = pm.Data('y', y)
         if trace is not None: # Used when estimating/predicting on a new site
-            weights_in_1_grp = from_posterior('w_in_1_grp', trace['w_in_1_grp'], 
+            weights_in_1_grp = from_posterior('w_in_1_grp', trace['w_in_1_grp'],
                                             distribution='normal', freedom=configs['freedom'])
             
             weights_in_1_grp_sd = from_posterior('w_in_1_grp_sd', trace['w_in_1_grp_sd'], 
-                                            distribution='hcauchy', freedom=configs['freedom'])
+                                            distribution='hnormal', freedom=configs['freedom'])
             
             if n_layers == 2:
                 weights_1_2_grp = from_posterior('w_1_2_grp', trace['w_1_2_grp'], 
                                                 distribution='normal', freedom=configs['freedom']) 
                 
                 weights_1_2_grp_sd = from_posterior('w_1_2_grp_sd', trace['w_1_2_grp_sd'], 
-                                                distribution='hcauchy', freedom=configs['freedom']) 
+                                                distribution='hnormal', freedom=configs['freedom']) 
                 
             weights_2_out_grp = from_posterior('w_2_out_grp', trace['w_2_out_grp'], 
                                             distribution='normal', freedom=configs['freedom']) 
             
             weights_2_out_grp_sd = from_posterior('w_2_out_grp_sd', trace['w_2_out_grp_sd'], 
-                                            distribution='hcauchy', freedom=configs['freedom'])
+                                            distribution='hnormal', freedom=configs['freedom'])
             
             mu_prior_intercept = from_posterior('mu_prior_intercept', trace['mu_prior_intercept'],
                                                 distribution='normal', freedom=configs['freedom'])
             sigma_prior_intercept = from_posterior('sigma_prior_intercept', trace['sigma_prior_intercept'],
-                                                distribution='hcauchy', freedom=configs['freedom'])
+                                                distribution='hnormal', freedom=configs['freedom'])
             
         else:
             # Group the mean distribution for input to the hidden layer:
-            weights_in_1_grp = pm.Normal('w_in_1_grp', 0, sd=1, 
-                                         shape=(feature_num, n_hidden), testval=init_1)
+            weights_in_1_grp = pm.Normal('w_in_1_grp', 0, sigma=1, 
+                                         shape=(feature_num, n_hidden), **{initval_kwarg: init_1})
             
             # Group standard deviation:
-            weights_in_1_grp_sd = pm.HalfCauchy('w_in_1_grp_sd', 1., 
-                                         shape=(feature_num, n_hidden), testval=std_init_1)
+            weights_in_1_grp_sd = pm.HalfNormal('w_in_1_grp_sd', sigma=1.,
+                                         shape=(feature_num, n_hidden), **{initval_kwarg: std_init_1})
             
             if n_layers == 2:
                 # Group the mean distribution for hidden layer 1 to hidden layer 2:
-                weights_1_2_grp = pm.Normal('w_1_2_grp', 0, sd=1, 
-                                            shape=(n_hidden, n_hidden), testval=init_2)
+                weights_1_2_grp = pm.Normal('w_1_2_grp', 0, sigma=1, 
+                                            shape=(n_hidden, n_hidden), **{initval_kwarg: init_2})
                 
                 # Group standard deviation:
-                weights_1_2_grp_sd = pm.HalfCauchy('w_1_2_grp_sd', 1., 
-                                            shape=(n_hidden, n_hidden), testval=std_init_2)
+                weights_1_2_grp_sd = pm.HalfNormal('w_1_2_grp_sd', sigma=1.,
+                                            shape=(n_hidden, n_hidden), **{initval_kwarg: std_init_2})
                 
             # Group the mean distribution for hidden to output:
-            weights_2_out_grp = pm.Normal('w_2_out_grp', 0, sd=1, 
-                                          shape=(n_hidden,), testval=init_out)
+            weights_2_out_grp = pm.Normal('w_2_out_grp', 0, sigma=1, 
+                                          shape=(n_hidden,), **{initval_kwarg: init_out})
             
             # Group standard deviation:
-            weights_2_out_grp_sd = pm.HalfCauchy('w_2_out_grp_sd', 1., 
-                                          shape=(n_hidden,), testval=std_init_out)
+            weights_2_out_grp_sd = pm.HalfNormal('w_2_out_grp_sd', sigma=1.,
+                                          shape=(n_hidden,), **{initval_kwarg: std_init_out})
             
             #mu_prior_intercept = pm.Uniform('mu_prior_intercept', lower=-100, upper=100)
             mu_prior_intercept = pm.Normal('mu_prior_intercept', mu=0., sigma=1e3)
-            sigma_prior_intercept = pm.HalfCauchy('sigma_prior_intercept', 5)
+            sigma_prior_intercept = pm.HalfNormal('sigma_prior_intercept', sigma=5.)
             
         # Now create separate weights for each group, by doing
         # weights * group_sd + group_mean, we make sure the new weights are
         # coming from the (group_mean, group_sd) distribution.
-        weights_in_1_raw = pm.Normal('w_in_1', 0, sd=1,
+        weights_in_1_raw = pm.Normal('w_in_1', 0, sigma=1,
                                      shape=(batch_effects_size + [feature_num, n_hidden]))
         weights_in_1 = weights_in_1_raw * weights_in_1_grp_sd + weights_in_1_grp
         
         if n_layers == 2:
-            weights_1_2_raw = pm.Normal('w_1_2', 0, sd=1,
+            weights_1_2_raw = pm.Normal('w_1_2', 0, sigma=1,
                                         shape=(batch_effects_size + [n_hidden, n_hidden]))
             weights_1_2 = weights_1_2_raw * weights_1_2_grp_sd + weights_1_2_grp
             
-        weights_2_out_raw = pm.Normal('w_2_out', 0, sd=1,
+        weights_2_out_raw = pm.Normal('w_2_out', 0, sigma=1,
                                       shape=(batch_effects_size + [n_hidden]))
         weights_2_out = weights_2_out_raw * weights_2_out_grp_sd + weights_2_out_grp
         
-        intercepts_offset = pm.Normal('intercepts_offset', mu=0, sd=1, 
+        intercepts_offset = pm.Normal('intercepts_offset', mu=0, sigma=1, 
                                           shape=(batch_effects_size))
        
-        intercepts = pm.Deterministic('intercepts', intercepts_offset + 
-                                      mu_prior_intercept*sigma_prior_intercept)
+        intercepts = mu_prior_intercept + intercepts_offset * sigma_prior_intercept
             
         # Build the neural network and estimate y_hat:
-        y_hat = theano.tensor.zeros(y.shape)
-        for be in be_idx:
-            # Find the indices corresponding to 'group be': 
-            a = []
-            for i, b in enumerate(be):
-                a.append(batch_effects[:,i]==b)
-            idx = reduce(np.logical_and, a).nonzero()
-            if idx[0].shape[0] != 0:
-                act_1 = pm.math.tanh(theano.tensor.dot(X[idx,:], weights_in_1[be]))
-                if n_layers == 2:
-                    act_2 = pm.math.tanh(theano.tensor.dot(act_1, weights_1_2[be]))
-                    y_hat = theano.tensor.set_subtensor(y_hat[idx,0], intercepts[be] + theano.tensor.dot(act_2, weights_2_out[be]))
-                else:
-                    y_hat = theano.tensor.set_subtensor(y_hat[idx,0], intercepts[be] + theano.tensor.dot(act_1, weights_2_out[be]))
+        y_hat = theano.tensor.zeros(y_shape)
+        for be, idx in be_idx:
+            act_1 = pm.math.tanh(theano.tensor.dot(X[idx,:], weights_in_1[be]))
+            if n_layers == 2:
+                act_2 = pm.math.tanh(theano.tensor.dot(act_1, weights_1_2[be]))
+                y_hat = theano.tensor.set_subtensor(y_hat[idx,0], intercepts[be] +
+                                    (act_2 * weights_2_out[be]).sum(axis=-1))
+            else:
+                y_hat = theano.tensor.set_subtensor(y_hat[idx,0], intercepts[be] +
+                                    (act_1 * weights_2_out[be]).sum(axis=-1))
                     
         # If we want to estimate varying noise terms across groups:
         if configs['random_noise']:
@@ -464,7 +725,7 @@ def nn_hbr(X, y, batch_effects, batch_effects_size, configs, trace=None):
                     
                     weights_in_1_grp_sd_noise = from_posterior('w_in_1_grp_sd_noise', 
                                                                trace['w_in_1_grp_sd_noise'], 
-                                                               distribution='hcauchy', freedom=configs['freedom'])
+                                                               distribution='hnormal', freedom=configs['freedom'])
                     
                     if n_layers == 2:
                         weights_1_2_grp_noise = from_posterior('w_1_2_grp_noise', 
@@ -473,7 +734,7 @@ def nn_hbr(X, y, batch_effects, batch_effects_size, configs, trace=None):
                         
                         weights_1_2_grp_sd_noise = from_posterior('w_1_2_grp_sd_noise', 
                                                                   trace['w_1_2_grp_sd_noise'], 
-                                                                  distribution='hcauchy', freedom=configs['freedom'])
+                                                                  distribution='hnormal', freedom=configs['freedom'])
                         
                     weights_2_out_grp_noise = from_posterior('w_2_out_grp_noise', 
                                                              trace['w_2_out_grp_noise'], 
@@ -481,123 +742,112 @@ def nn_hbr(X, y, batch_effects, batch_effects_size, configs, trace=None):
                     
                     weights_2_out_grp_sd_noise = from_posterior('w_2_out_grp_sd_noise', 
                                                                 trace['w_2_out_grp_sd_noise'], 
-                                                                distribution='hcauchy', freedom=configs['freedom'])
+                                                                distribution='hnormal', freedom=configs['freedom'])
                     
                 else:
                     # The input layer to the first hidden layer:
-                    weights_in_1_grp_noise = pm.Normal('w_in_1_grp_noise', 0, sd=1, 
+                    weights_in_1_grp_noise = pm.Normal('w_in_1_grp_noise', 0, sigma=1, 
                                                shape=(feature_num,n_hidden), 
-                                               testval=init_1_noise)
-                    weights_in_1_grp_sd_noise = pm.HalfCauchy('w_in_1_grp_sd_noise', 1, 
+                                               **{initval_kwarg: init_1_noise})
+                    weights_in_1_grp_sd_noise = pm.HalfNormal('w_in_1_grp_sd_noise', sigma=1.,
                                                shape=(feature_num,n_hidden), 
-                                               testval=std_init_1_noise)
+                                               **{initval_kwarg: std_init_1_noise})
                     
                     
                     # The first hidden layer to second hidden layer:
                     if n_layers == 2:
-                        weights_1_2_grp_noise = pm.Normal('w_1_2_grp_noise', 0, sd=1, 
+                        weights_1_2_grp_noise = pm.Normal('w_1_2_grp_noise', 0, sigma=1, 
                                                           shape=(n_hidden, n_hidden), 
-                                                          testval=init_2_noise)
-                        weights_1_2_grp_sd_noise = pm.HalfCauchy('w_1_2_grp_sd_noise', 1, 
+                                                          **{initval_kwarg: init_2_noise})
+                        weights_1_2_grp_sd_noise = pm.HalfNormal('w_1_2_grp_sd_noise', sigma=1.,
                                                           shape=(n_hidden, n_hidden), 
-                                                          testval=std_init_2_noise)
+                                                          **{initval_kwarg: std_init_2_noise})
                         
                     # The second hidden layer to output layer:
-                    weights_2_out_grp_noise = pm.Normal('w_2_out_grp_noise', 0, sd=1, 
+                    weights_2_out_grp_noise = pm.Normal('w_2_out_grp_noise', 0, sigma=1, 
                                                         shape=(n_hidden,), 
-                                                        testval=init_out_noise)
-                    weights_2_out_grp_sd_noise = pm.HalfCauchy('w_2_out_grp_sd_noise', 1, 
+                                                        **{initval_kwarg: init_out_noise})
+                    weights_2_out_grp_sd_noise = pm.HalfNormal('w_2_out_grp_sd_noise', sigma=1.,
                                                         shape=(n_hidden,), 
-                                                        testval=std_init_out_noise)
+                                                        **{initval_kwarg: std_init_out_noise})
                     
                     #mu_prior_intercept_noise = pm.HalfNormal('mu_prior_intercept_noise', sigma=1e3)
                     #sigma_prior_intercept_noise = pm.HalfCauchy('sigma_prior_intercept_noise', 5)
             
                 # Now create separate weights for each group:
-                weights_in_1_raw_noise = pm.Normal('w_in_1_noise', 0, sd=1,
+                weights_in_1_raw_noise = pm.Normal('w_in_1_noise', 0, sigma=1,
                                                    shape=(batch_effects_size + [feature_num, n_hidden]))
                 weights_in_1_noise = weights_in_1_raw_noise * weights_in_1_grp_sd_noise + weights_in_1_grp_noise
                 
                 if n_layers == 2:
-                    weights_1_2_raw_noise = pm.Normal('w_1_2_noise', 0, sd=1,
+                    weights_1_2_raw_noise = pm.Normal('w_1_2_noise', 0, sigma=1,
                                                       shape=(batch_effects_size + [n_hidden, n_hidden]))
                     weights_1_2_noise = weights_1_2_raw_noise * weights_1_2_grp_sd_noise + weights_1_2_grp_noise
                     
-                weights_2_out_raw_noise = pm.Normal('w_2_out_noise', 0, sd=1,
+                weights_2_out_raw_noise = pm.Normal('w_2_out_noise', 0, sigma=1,
                                                     shape=(batch_effects_size + [n_hidden]))
                 weights_2_out_noise = weights_2_out_raw_noise * weights_2_out_grp_sd_noise + weights_2_out_grp_noise
                 
-                #intercepts_offset_noise = pm.Normal('intercepts_offset_noise', mu=0, sd=1, 
+                #intercepts_offset_noise = pm.Normal('intercepts_offset_noise', mu=0, sigma=1, 
                 #                          shape=(batch_effects_size))
        
                 #intercepts_noise = pm.Deterministic('intercepts_noise', mu_prior_intercept_noise + 
                 #                      intercepts_offset_noise * sigma_prior_intercept_noise)
                 
                 # Build the neural network and estimate the sigma_y:
-                sigma_y = theano.tensor.zeros(y.shape)
-                for be in be_idx:
-                    a = []
-                    for i, b in enumerate(be):
-                        a.append(batch_effects[:,i]==b) 
-                    idx = reduce(np.logical_and, a).nonzero()
-                    if idx[0].shape[0] != 0:
-                        act_1_noise = pm.math.sigmoid(theano.tensor.dot(X[idx,:], weights_in_1_noise[be]))
-                        if n_layers == 2:
-                            act_2_noise = pm.math.sigmoid(theano.tensor.dot(act_1_noise, weights_1_2_noise[be]))
-                            temp = pm.math.log1pexp(theano.tensor.dot(act_2_noise, weights_2_out_noise[be])) + 1e-5
-                        else:
-                            temp = pm.math.log1pexp(theano.tensor.dot(act_1_noise, weights_2_out_noise[be])) + 1e-5
-                        sigma_y = theano.tensor.set_subtensor(sigma_y[idx,0], temp)
+                sigma_y = theano.tensor.zeros(y_shape)
+                for be, idx in be_idx:
+                    act_1_noise = pm.math.sigmoid(theano.tensor.dot(X[idx,:], weights_in_1_noise[be]))
+                    if n_layers == 2:
+                        act_2_noise = pm.math.sigmoid(theano.tensor.dot(act_1_noise, weights_1_2_noise[be]))
+                        temp = pm.math.log1pexp((act_2_noise *
+                                    weights_2_out_noise[be]).sum(axis=-1)) + 1e-5
+                    else:
+                        temp = pm.math.log1pexp((act_1_noise *
+                                    weights_2_out_noise[be]).sum(axis=-1)) + 1e-5
+                    sigma_y = theano.tensor.set_subtensor(sigma_y[idx,0], temp)
                 
             else: # homoscedastic noise:
                 if trace is not None: # Used for transferring the priors
-                    upper_bound =  np.percentile(trace['sigma_noise'], 95)
-                    sigma_noise = pm.Uniform('sigma_noise', lower=0, upper=2*upper_bound, shape=(batch_effects_size))
+                    sigma_noise = from_posterior('sigma_noise', trace['sigma_noise'],
+                                                 distribution='hnormal', freedom=configs['freedom'])
                 else:
-                    sigma_noise = pm.Uniform('sigma_noise', lower=0, upper=100, shape=(batch_effects_size))
+                    sigma_noise = pm.HalfNormal('sigma_noise', sigma=10., shape=(batch_effects_size))
                     
-                sigma_y = theano.tensor.zeros(y.shape)
-                for be in be_idx:
-                    a = []
-                    for i, b in enumerate(be):
-                        a.append(batch_effects[:,i]==b)             
-                    idx = reduce(np.logical_and, a).nonzero()
-                    if idx[0].shape[0]!=0:
-                        sigma_y = theano.tensor.set_subtensor(sigma_y[idx,0], sigma_noise[be])
+                sigma_y = theano.tensor.zeros(y_shape)
+                for be, idx in be_idx:
+                    sigma_y = theano.tensor.set_subtensor(sigma_y[idx,0], sigma_noise[be])
         
         else: # do not allow for random noise terms across groups:
             if trace is not None: # Used for transferring the priors
-                upper_bound =  np.percentile(trace['sigma_noise'], 95)
-                sigma_noise = pm.Uniform('sigma_noise', lower=0, upper=2*upper_bound)
+                sigma_noise = from_posterior('sigma_noise', trace['sigma_noise'],
+                                             distribution='hnormal', freedom=configs['freedom'])
             else:
-                sigma_noise = pm.Uniform('sigma_noise', lower=0, upper=100)
-            sigma_y = theano.tensor.zeros(y.shape)
-            for be in be_idx:
-                a = []
-                for i, b in enumerate(be):
-                    a.append(batch_effects[:,i]==b)
-                idx = reduce(np.logical_and, a).nonzero()
-                if idx[0].shape[0]!=0:
-                    sigma_y = theano.tensor.set_subtensor(sigma_y[idx,0], sigma_noise)
+                sigma_noise = pm.HalfNormal('sigma_noise', sigma=10.)
+            sigma_y = theano.tensor.zeros(y_shape)
+            for be, idx in be_idx:
+                sigma_y = theano.tensor.set_subtensor(sigma_y[idx,0], sigma_noise)
         
         if configs['skewed_likelihood']:
             skewness = pm.Uniform('skewness', lower=-10, upper=10, shape=(batch_effects_size))
-            alpha = theano.tensor.zeros(y.shape)
-            for be in be_idx:
-                a = []
-                for i, b in enumerate(be):
-                    a.append(batch_effects[:,i]==b)             
-                idx = reduce(np.logical_and, a).nonzero()
-                if idx[0].shape[0]!=0:
-                    alpha = theano.tensor.set_subtensor(alpha[idx,0], skewness[be])
+            alpha = theano.tensor.zeros(y_shape)
+            for be, idx in be_idx:
+                alpha = theano.tensor.set_subtensor(alpha[idx,0], skewness[be])
         else: 
             alpha = 0 # symmetrical normal distribution
         
-        y_like = pm.SkewNormal('y_like', mu=y_hat, sigma=sigma_y, alpha=alpha, observed=y) 
-        
+        y_like = pm.SkewNormal('y_like', mu=y_hat, sigma=sigma_y, alpha=alpha, observed=y)
+
     return model
 
 
+# Compiled models keyed on their structure (model type, configs and data
+# shapes), shared by all HBR instances in the process: normative.estimate
+# builds a fresh HBR per response variable, so an instance-level cache would
+# never be reused across the voxel-wise loop.
+model_cache = {}
+
+
 class HBR:
     """Hierarchical Bayesian Regression for normative modeling
 
@@ -611,7 +861,9 @@ class HBR:
 
     :param configs: a dictionary of model configurations.
     :param X: N-by-P input matrix of P features for N subjects
-    :param y: N-by-1 vector of outputs. 
+    :param y: N-by-V matrix of V response variables (e.g., voxels) for N
+     subjects. A single response may be passed as an N-by-1 matrix or a
+     plain vector; the nn model supports a single response only.
     :param batch_effects: N-by-B matrix of B batch ids for N subjects.
 
     :returns: * ys - predictive mean
@@ -621,66 +873,133 @@ class HBR:
     """
 
     def __init__(self, configs):
-        
+
         self.model_type = configs['type']
         self.configs = configs
+        self.response_num = 1
+
+
+    def get_model(self, X, y, batch_effects, trace=None, shared=True):
+        """ Function to create the model, reusing the cached compiled graph
+        when only the data changed. Rebuilding a pymc3 model re-runs theano's
+        graph optimization and C compilation; when the model structure is
+        unchanged, it is enough to swap the values of the shared variables.
+        The cache lives at module level because normative.estimate constructs
+        a fresh HBR per response variable, so it has to outlive the instance
+        for the voxel-wise loop to reuse the compiled graph. With
+        shared=False a one-shot graph is built on constant data, which avoids
+        the slow path that sample_posterior_predictive takes on shared
+        inputs. """
+
+        if not shared:
+            if self.model_type == 'nn':
+                return nn_hbr(X, y, batch_effects, self.batch_effects_size,
+                              self.configs, trace, shared=False)
+            else:
+                return hbr(X, y, batch_effects, self.batch_effects_size,
+                           self.configs, trace, shared=False)
+
+        model_key = (self.model_type, tuple(sorted(self.configs.items())),
+                     X.shape, y.shape, batch_effects.tobytes())
+        cached = model_cache.get(model_key)
+        if cached is None or cached[1] is not trace:
+            if self.model_type == 'nn':
+                model = nn_hbr(X, y, batch_effects, self.batch_effects_size,
+                               self.configs, trace)
+            else:
+                model = hbr(X, y, batch_effects, self.batch_effects_size,
+                            self.configs, trace)
+            model_cache[model_key] = (model, trace)
+        else:
+            model = cached[0]
+            pm.set_data({'X': pm.floatX(X), 'y': pm.floatX(y)}, model=model)
+
+        return model
+
+
+    def sample_nuts(self):
+        """ Function to run NUTS on the current model context. With
+        nuts_sampler='numpyro' the XLA-compiled NumPyro implementation is
+        used when the installed pymc3 provides the jax sampling module,
+        otherwise it falls back to the default sampler. """
+
+        if self.configs.get('nuts_sampler', 'pymc3') == 'numpyro':
+            # the jax sampling module moved with the pymc3 -> pymc rename
+            sample_numpyro_nuts = None
+            for module in ('pymc3.sampling_jax', 'pymc.sampling.jax',
+                           'pymc.sampling_jax'):
+                try:
+                    sample_numpyro_nuts = getattr(
+                        importlib.import_module(module), 'sample_numpyro_nuts')
+                    break
+                except (ImportError, AttributeError):
+                    continue
+            if sample_numpyro_nuts is None:
+                print('NumPyro NUTS is not available, falling back to pymc3 NUTS.')
+            else:
+                idata = sample_numpyro_nuts(self.configs['n_samples'],
+                                            tune=self.configs['n_tuning'],
+                                            chains=self.configs['n_chains'],
+                                            target_accept=self.configs['target_accept'])
+                # sample_numpyro_nuts returns an arviz InferenceData;
+                # flatten the chains into per-variable sample arrays so the
+                # trace consumers (the moment helpers, from_posterior and
+                # sample_ppc) see the same mapping a MultiTrace provides.
+                trace = {}
+                for var in idata.posterior.data_vars:
+                    vals = idata.posterior[var].values
+                    trace[var] = vals.reshape((-1,) + vals.shape[2:])
+                return trace
+
+        sample_kwargs = {}
+        sample_params = inspect.signature(pm.sample).parameters
+        if 'mp_ctx' in sample_params:
+            # Forking is much cheaper than spawning because the compiled
+            # theano graph does not have to be re-imported per chain.
+            sample_kwargs['mp_ctx'] = 'fork'
+        if 'return_inferencedata' in sample_params:
+            # later pymc versions default to InferenceData; keep the
+            # MultiTrace return the trace consumers expect
+            sample_kwargs['return_inferencedata'] = False
+
+        return pm.sample(self.configs['n_samples'],
+                         tune=self.configs['n_tuning'],
+                         chains=self.configs['n_chains'],
+                         target_accept=self.configs['target_accept'],
+                         init=self.configs['init'], n_init=50000,
+                         cores=self.configs['cores'], **sample_kwargs)
+
 
-            
     def estimate(self, X, y, batch_effects):
         """ Function to estimate the model """
-        
+
         if len(X.shape)==1:
             X = np.expand_dims(X, axis=1)
         if len(y.shape)==1:
             y = np.expand_dims(y, axis=1)
         if len(batch_effects.shape)==1:
             batch_effects = np.expand_dims(batch_effects, axis=1)
-        
+
         self.batch_effects_num = batch_effects.shape[1]
         self.batch_effects_size = []
         for i in range(self.batch_effects_num):
             self.batch_effects_size.append(len(np.unique(batch_effects[:,i])))
-        
-        if self.model_type == 'linear': 
-            with hbr(X, y, batch_effects, self.batch_effects_size, 
-                               self.configs):    
-                self.trace = pm.sample(self.configs['n_samples'], 
-                                       tune=self.configs['n_tuning'], 
-                                       chains=self.configs['n_chains'],  
-                                       target_accept=self.configs['target_accept'], 
-                                       init=self.configs['init'], n_init=50000, 
-                                       cores=self.configs['cores'])
-        elif self.model_type == 'polynomial': 
+        # All response columns are fitted jointly in one compiled graph; the
+        # prediction methods need the count to rebuild matching graphs.
+        self.response_num = y.shape[1]
+        if self.model_type == 'nn' and self.response_num > 1:
+            raise ValueError("The nn model fits a single response variable, "
+                             "but y has " + str(self.response_num) + " columns.")
+
+        if self.model_type == 'polynomial':
             X = create_poly_basis(X, self.configs['order'])
-            with hbr(X, y, batch_effects, self.batch_effects_size, 
-                               self.configs):    
-                self.trace = pm.sample(self.configs['n_samples'], 
-                                       tune=self.configs['n_tuning'], 
-                                       chains=self.configs['n_chains'],  
-                                       target_accept=self.configs['target_accept'], 
-                                       init=self.configs['init'], n_init=50000, 
-                                       cores=self.configs['cores'])
-        elif self.model_type == 'bspline': 
+        elif self.model_type == 'bspline':
             self.bsp = bspline_fit(X, self.configs['order'], self.configs['nknots'])
             X = bspline_transform(X, self.bsp)
-            with hbr(X, y, batch_effects, self.batch_effects_size, 
-                               self.configs):    
-                self.trace = pm.sample(self.configs['n_samples'], 
-                                       tune=self.configs['n_tuning'], 
-                                       chains=self.configs['n_chains'],  
-                                       target_accept=self.configs['target_accept'], 
-                                       init=self.configs['init'], n_init=50000, 
-                                       cores=self.configs['cores'])
-        elif self.model_type == 'nn': 
-            with nn_hbr(X, y, batch_effects, self.batch_effects_size, 
-                               self.configs):    
-                self.trace = pm.sample(self.configs['n_samples'], 
-                                       tune=self.configs['n_tuning'], 
-                                       chains=self.configs['n_chains'], 
-                                       target_accept=self.configs['target_accept'], 
-                                       init=self.configs['init'], n_init=50000, 
-                                       cores=self.configs['cores'])
-                
+
+        with self.get_model(X, y, batch_effects):
+            self.trace = self.sample_nuts()
+
         return self.trace
 
     def predict(self, X, batch_effects, pred = 'single'):
@@ -693,25 +1012,25 @@ class HBR:
         
         samples = self.configs['n_samples']
         if pred == 'single':
-            y = np.zeros([X.shape[0],1])
-            if self.model_type == 'linear': 
-                with hbr(X, y, batch_effects, self.batch_effects_size, self.configs):
-                    ppc = pm.sample_posterior_predictive(self.trace, samples=samples, progressbar=True) 
-            elif self.model_type == 'polynomial':
+            if self.model_type == 'polynomial':
                 X = create_poly_basis(X, self.configs['order'])
-                with hbr(X, y, batch_effects, self.batch_effects_size, self.configs):
-                    ppc = pm.sample_posterior_predictive(self.trace, samples=samples, progressbar=True) 
-            elif self.model_type == 'bspline': 
+            elif self.model_type == 'bspline':
                 X = bspline_transform(X, self.bsp)
-                with hbr(X, y, batch_effects, self.batch_effects_size, self.configs):
-                    ppc = pm.sample_posterior_predictive(self.trace, samples=samples, progressbar=True) 
-            elif self.model_type == 'nn': 
-                with nn_hbr(X, y, batch_effects, self.batch_effects_size, self.configs):
-                    ppc = pm.sample_posterior_predictive(self.trace, samples=samples, progressbar=True) 
-            
-            pred_mean = ppc['y_like'].mean(axis=0)
-            pred_var = ppc['y_like'].var(axis=0)
-        
+
+            if not self.configs['skewed_likelihood']:
+                if self.model_type == 'nn':
+                    pred_mean, pred_var = nn_hbr_moments(X, batch_effects,
+                                                         self.configs, self.trace)
+                else:
+                    pred_mean, pred_var = hbr_moments(X, batch_effects,
+                                                      self.configs, self.trace)
+            else:
+                y = np.zeros([X.shape[0], self.response_num])
+                with self.get_model(X, y, batch_effects, shared=False):
+                    ppc = sample_ppc(self.trace, samples, progressbar=True)
+
+                pred_mean, pred_var = ppc_moments(ppc['y_like'])
+
         return pred_mean, pred_var
     
 
@@ -729,46 +1048,19 @@ class HBR:
         self.batch_effects_size = []
         for i in range(self.batch_effects_num):
             self.batch_effects_size.append(len(np.unique(batch_effects[:,i])))
-            
-        if self.model_type == 'linear': 
-            with hbr(X, y, batch_effects, self.batch_effects_size, 
-                               self.configs, trace = self.trace):    
-                self.trace = pm.sample(self.configs['n_samples'], 
-                                       tune=self.configs['n_tuning'], 
-                                       chains=self.configs['n_chains'],  
-                                       target_accept=self.configs['target_accept'], 
-                                       init=self.configs['init'], n_init=50000, 
-                                       cores=self.configs['cores'])
-        elif self.model_type == 'polynomial': 
+        self.response_num = y.shape[1]
+        if self.model_type == 'nn' and self.response_num > 1:
+            raise ValueError("The nn model fits a single response variable, "
+                             "but y has " + str(self.response_num) + " columns.")
+
+        if self.model_type == 'polynomial':
             X = create_poly_basis(X, self.configs['order'])
-            with hbr(X, y, batch_effects, self.batch_effects_size, 
-                               self.configs, trace = self.trace):    
-                self.trace = pm.sample(self.configs['n_samples'], 
-                                       tune=self.configs['n_tuning'], 
-                                       chains=self.configs['n_chains'],  
-                                       target_accept=self.configs['target_accept'], 
-                                       init=self.configs['init'], n_init=50000, 
-                                       cores=self.configs['cores'])
-        if self.model_type == 'bspline': 
+        elif self.model_type == 'bspline':
             X = bspline_transform(X, self.bsp)
-            with hbr(X, y, batch_effects, self.batch_effects_size, 
-                               self.configs, trace = self.trace):    
-                self.trace = pm.sample(self.configs['n_samples'], 
-                                       tune=self.configs['n_tuning'], 
-                                       chains=self.configs['n_chains'], 
-                                       target_accept=self.configs['target_accept'], 
-                                       init=self.configs['init'], n_init=50000, 
-                                       cores=self.configs['cores'])
-        elif self.model_type == 'nn': 
-            with nn_hbr(X, y, batch_effects, self.batch_effects_size, 
-                               self.configs, trace = self.trace):    
-                self.trace = pm.sample(self.configs['n_samples'], 
-                                       tune=self.configs['n_tuning'], 
-                                       chains=self.configs['n_chains'], 
-                                       target_accept=self.configs['target_accept'], 
-                                       init=self.configs['init'], n_init=50000, 
-                                       cores=self.configs['cores'])
-                
+
+        with self.get_model(X, y, batch_effects, trace=self.trace):
+            self.trace = self.sample_nuts()
+
         return self.trace
         
     
@@ -781,25 +1073,19 @@ class HBR:
             batch_effects = np.expand_dims(batch_effects, axis=1)
         
         samples = self.configs['n_samples']
-        y = np.zeros([X.shape[0],1])
-        if self.model_type == 'linear': 
-            with hbr(X, y, batch_effects, self.batch_effects_size, self.configs, trace = self.trace):
-                ppc = pm.sample_posterior_predictive(self.trace, samples=samples, progressbar=True) 
-        elif self.model_type == 'polynomial': 
+        y = np.zeros([X.shape[0], self.response_num])
+
+        if self.model_type == 'polynomial':
             X = create_poly_basis(X, self.configs['order'])
-            with hbr(X, y, batch_effects, self.batch_effects_size, self.configs, trace = self.trace):
-                ppc = pm.sample_posterior_predictive(self.trace, samples=samples, progressbar=True) 
-        elif self.model_type == 'bspline': 
+        elif self.model_type == 'bspline':
             X = bspline_transform(X, self.bsp)
-            with hbr(X, y, batch_effects, self.batch_effects_size, self.configs, trace = self.trace):
-                ppc = pm.sample_posterior_predictive(self.trace, samples=samples, progressbar=True) 
-        elif self.model_type == 'nn': 
-            with nn_hbr(X, y, batch_effects, self.batch_effects_size, self.configs, trace = self.trace):
-                ppc = pm.sample_posterior_predictive(self.trace, samples=samples, progressbar=True) 
-            
-        pred_mean = ppc['y_like'].mean(axis=0)
-        pred_var = ppc['y_like'].var(axis=0)
-        
+
+        with self.get_model(X, y, batch_effects, trace=self.trace,
+                            shared=False):
+            ppc = sample_ppc(self.trace, samples, progressbar=True)
+
+        pred_mean, pred_var = ppc_moments(ppc['y_like'])
+
         return pred_mean, pred_var
     
 
@@ -811,30 +1097,27 @@ class HBR:
         if len(batch_effects.shape)==1:
             batch_effects = np.expand_dims(batch_effects, axis=1)
                 
-        y = np.zeros([X.shape[0],1])
-        if self.model_type == 'linear': 
-            with hbr(X, y, batch_effects, self.batch_effects_size, self.configs):
-                ppc = pm.sample_posterior_predictive(self.trace, samples=samples, progressbar=True) 
-        elif self.model_type == 'polynomial':
+        y = np.zeros([X.shape[0], self.response_num])
+
+        if self.model_type == 'polynomial':
             X = create_poly_basis(X, self.configs['order'])
-            with hbr(X, y, batch_effects, self.batch_effects_size, self.configs):
-                ppc = pm.sample_posterior_predictive(self.trace, samples=samples, progressbar=True) 
-        elif self.model_type == 'bspline': 
+        elif self.model_type == 'bspline':
             X = bspline_transform(X, self.bsp)
-            with hbr(X, y, batch_effects, self.batch_effects_size, self.configs):
-                ppc = pm.sample_posterior_predictive(self.trace, samples=samples, progressbar=True) 
-        elif self.model_type == 'nn': 
-            with nn_hbr(X, y, batch_effects, self.batch_effects_size, self.configs):
-                ppc = pm.sample_posterior_predictive(self.trace, samples=samples, progressbar=True) 
-        
-        generated_samples = np.reshape(ppc['y_like'].squeeze().T, [X.shape[0]*samples, 1])
-        X = np.repeat(X, samples)
-        if len(X.shape)==1:
-            X = np.expand_dims(X, axis=1)
+
+        with self.get_model(X, y, batch_effects, shared=False):
+            ppc = sample_ppc(self.trace, samples, progressbar=True)
+
+        # y_like is (samples, N, V); move the sample axis behind the row
+        # axis so each row's draws stay contiguous and the response axis
+        # survives the reshape.
+        generated_samples = np.reshape(ppc['y_like'].transpose(1, 0, 2),
+                                       [X.shape[0]*samples, self.response_num])
+        # Repeating along axis 0 keeps the rows aligned with the reshaped
+        # draws for any number of features; X and batch_effects are already
+        # 2D here, so no re-expansion is needed afterwards.
+        X = np.repeat(X, samples, axis=0)
         batch_effects = np.repeat(batch_effects, samples, axis=0)
-        if len(batch_effects.shape)==1:
-            batch_effects = np.expand_dims(batch_effects, axis=1)
-        
+
         return X, batch_effects, generated_samples
     
     
@@ -850,28 +1133,17 @@ class HBR:
         self.batch_effects_size = []
         for i in range(self.batch_effects_num):
             self.batch_effects_size.append(len(np.unique(batch_effects[:,i])))
-                
-        y = np.zeros([X.shape[0],1])
-        
-        if self.model_type == 'linear': 
-            with hbr(X, y, batch_effects, self.batch_effects_size, self.configs,
-                     trace):
-                ppc = pm.sample_prior_predictive(samples=samples) 
-        elif self.model_type == 'polynomial':
+
+        y = np.zeros([X.shape[0], self.response_num])
+
+        if self.model_type == 'polynomial':
             X = create_poly_basis(X, self.configs['order'])
-            with hbr(X, y, batch_effects, self.batch_effects_size, self.configs,
-                     trace):
-                ppc = pm.sample_prior_predictive(samples=samples) 
-        elif self.model_type == 'bspline': 
+        elif self.model_type == 'bspline':
             self.bsp = bspline_fit(X, self.configs['order'], self.configs['nknots'])
             X = bspline_transform(X, self.bsp)
-            with hbr(X, y, batch_effects, self.batch_effects_size, self.configs,
-                     trace):
-                ppc = pm.sample_prior_predictive(samples=samples) 
-        elif self.model_type == 'nn': 
-            with nn_hbr(X, y, batch_effects, self.batch_effects_size, self.configs,
-                        trace):
-                ppc = pm.sample_prior_predictive(samples=samples) 
-        
+
+        with self.get_model(X, y, batch_effects, trace=trace, shared=False):
+            ppc = pm.sample_prior_predictive(samples=samples)
+
         return ppc
     
\ No newline at end of file
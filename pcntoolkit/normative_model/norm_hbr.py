@@ -47,7 +47,10 @@ class NormHBR(NormBase):
         self.configs['n_chains'] = int(kwargs.pop('n_chains', '1'))
         self.configs['target_accept'] = float(kwargs.pop('target_accept', '0.8'))
         self.configs['init'] = kwargs.pop('init', 'jitter+adapt_diag')
-        self.configs['cores'] = int(kwargs.pop('cores', '1'))
+        self.configs['nuts_sampler'] = kwargs.pop('nuts_sampler', 'pymc3')
+        # By default give each chain its own core so they run in parallel.
+        self.configs['cores'] = int(kwargs.pop('cores',
+                                               self.configs['n_chains']))
         self.configs['freedom'] = int(kwargs.pop('freedom', '1'))
         
         if self.configs['type'] == 'bspline':
@@ -41,10 +41,14 @@ def create_poly_basis(X, dimpoly):
     D = X.shape[1]
     Phi = np.zeros((X.shape[0], D*dimpoly))
     colid = np.arange(0, D)
+    # Build the powers Horner-style with a running product: one multiply
+    # per degree instead of a full exponentiation per column block.
+    Xpow = np.ones_like(X, dtype=Phi.dtype)
     for d in range(1, dimpoly+1):
-        Phi[:, colid] = X ** d
+        Xpow = Xpow * X
+        Phi[:, colid] = Xpow
         colid += D
-        
+
     return Phi
 
 def create_bspline_basis(xmin, xmax, p = 3, nknots = 5):
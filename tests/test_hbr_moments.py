@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Cross-checks for the vectorized predictive moment helpers in pcntoolkit.hbr.
+The broadcast implementations used by HBR.predict are compared against naive
+per-sample reference loops on synthetic traces, so changes to the trace
+layout cannot silently break the non-skewed predict path. These tests are
+pure numpy and do not require sampling.
+"""
+
+import numpy as np
+
+from pcntoolkit.hbr import hbr_moments, nn_hbr_moments, ppc_moments
+
+SAMPLE_NUM = 25
+N = 40
+FEATURE_NUM = 3
+RESPONSE_NUM = 2
+N_HIDDEN = 4
+BATCH_EFFECTS_SIZE = [2, 3]
+
+
+def simulate_batch_effects(rng):
+    return np.stack([rng.integers(0, n, N) for n in BATCH_EFFECTS_SIZE],
+                    axis=1).astype(float)
+
+
+def simulate_linear_trace(rng, configs):
+    """ draw a synthetic trace with the variables hbr() samples, honouring
+    the shapes implied by the random_intercept/slope/noise switches """
+
+    S, F, R = SAMPLE_NUM, FEATURE_NUM, RESPONSE_NUM
+    bes = BATCH_EFFECTS_SIZE
+    trace = {
+        'mu_prior_intercept': rng.normal(size=(S, R)),
+        'log_sigma_prior_intercept': rng.normal(size=(S, R)) * 0.1,
+        'mu_prior_slope': rng.normal(size=(S, F, R)),
+        'log_sigma_prior_slope': rng.normal(size=(S, F, R)) * 0.1,
+    }
+    if configs['random_intercept']:
+        trace['intercepts_offset'] = rng.normal(size=(S, *bes, R))
+    else:
+        trace['intercepts_offset'] = rng.normal(size=(S, R))
+    if configs['random_slope']:
+        trace['slopes_offset'] = rng.normal(size=(S, *bes, F, R))
+    else:
+        trace['slopes_offset'] = rng.normal(size=(S, F, R))
+    if configs['random_noise'] and configs['hetero_noise']:
+        trace['mu_prior_intercept_noise'] = np.abs(rng.normal(size=(S, R)))
+        trace['log_sigma_prior_intercept_noise'] = rng.normal(size=(S, R)) * 0.1
+        trace['mu_prior_slope_noise'] = rng.normal(size=(S, F, R))
+        trace['log_sigma_prior_slope_noise'] = rng.normal(size=(S, F, R)) * 0.1
+        if configs['random_intercept']:
+            trace['intercepts_noise_offset'] = rng.normal(size=(S, *bes, R))
+        else:
+            trace['intercepts_noise_offset'] = rng.normal(size=(S, R))
+        if configs['random_slope']:
+            trace['slopes_noise_offset'] = rng.normal(size=(S, *bes, F, R))
+        else:
+            trace['slopes_noise_offset'] = rng.normal(size=(S, F, R))
+    elif configs['random_noise']:
+        trace['log_sigma_noise'] = rng.normal(size=(S, *bes, R)) * 0.3
+    else:
+        trace['log_sigma_noise'] = rng.normal(size=(S, R)) * 0.3
+    return trace
+
+
+def naive_hbr_moments(X, batch_effects, configs, trace):
+    """ per-sample, per-subject reference implementation """
+
+    S = SAMPLE_NUM
+    mu = np.zeros((S, N, RESPONSE_NUM))
+    s2 = np.zeros((S, N, RESPONSE_NUM))
+    for s in range(S):
+        for n in range(N):
+            be = tuple(int(v) for v in batch_effects[n])
+            ic = be if configs['random_intercept'] else ()
+            sl = be if configs['random_slope'] else ()
+            intercepts = (trace['mu_prior_intercept'][s] +
+                          trace['intercepts_offset'][s][ic] *
+                          np.exp(trace['log_sigma_prior_intercept'][s]))
+            slopes = (trace['mu_prior_slope'][s] +
+                      trace['slopes_offset'][s][sl] *
+                      np.exp(trace['log_sigma_prior_slope'][s]))
+            mu[s, n] = intercepts + X[n] @ slopes
+            if configs['random_noise'] and configs['hetero_noise']:
+                intercepts_noise = (trace['mu_prior_intercept_noise'][s] +
+                                    trace['intercepts_noise_offset'][s][ic] *
+                                    np.exp(trace['log_sigma_prior_intercept_noise'][s]))
+                slopes_noise = (trace['mu_prior_slope_noise'][s] +
+                                trace['slopes_noise_offset'][s][sl] *
+                                np.exp(trace['log_sigma_prior_slope_noise'][s]))
+                sigma_y = np.logaddexp(0, intercepts_noise +
+                                       X[n] @ slopes_noise) + 1e-5
+            elif configs['random_noise']:
+                sigma_y = np.exp(trace['log_sigma_noise'][s][be])
+            else:
+                sigma_y = np.exp(trace['log_sigma_noise'][s])
+            s2[s, n] = sigma_y ** 2
+    return mu.mean(axis=0), mu.var(axis=0) + s2.mean(axis=0)
+
+
+def test_hbr_moments():
+    rng = np.random.default_rng(0)
+    X = rng.normal(size=(N, FEATURE_NUM))
+    batch_effects = simulate_batch_effects(rng)
+    for random_intercept in (True, False):
+        for random_slope in (True, False):
+            for random_noise, hetero_noise in ((True, True), (True, False),
+                                               (False, False)):
+                configs = {'random_intercept': random_intercept,
+                           'random_slope': random_slope,
+                           'random_noise': random_noise,
+                           'hetero_noise': hetero_noise}
+                trace = simulate_linear_trace(rng, configs)
+                pred_mean, pred_var = hbr_moments(X, batch_effects, configs,
+                                                  trace)
+                ref_mean, ref_var = naive_hbr_moments(X, batch_effects,
+                                                      configs, trace)
+                assert np.allclose(pred_mean, ref_mean), configs
+                assert np.allclose(pred_var, ref_var), configs
+
+
+def simulate_nn_trace(rng, configs):
+    S, F, H = SAMPLE_NUM, FEATURE_NUM, N_HIDDEN
+    bes = BATCH_EFFECTS_SIZE
+    trace = {
+        'w_in_1_grp': rng.normal(size=(S, F, H)),
+        'w_in_1_grp_sd': np.abs(rng.normal(size=(S, F, H))),
+        'w_in_1': rng.normal(size=(S, *bes, F, H)),
+        'w_2_out_grp': rng.normal(size=(S, H)),
+        'w_2_out_grp_sd': np.abs(rng.normal(size=(S, H))),
+        'w_2_out': rng.normal(size=(S, *bes, H)),
+        'mu_prior_intercept': rng.normal(size=(S,)),
+        'sigma_prior_intercept': np.abs(rng.normal(size=(S,))),
+        'intercepts_offset': rng.normal(size=(S, *bes)),
+    }
+    if configs['nn_hidden_layers_num'] == 2:
+        trace['w_1_2_grp'] = rng.normal(size=(S, H, H))
+        trace['w_1_2_grp_sd'] = np.abs(rng.normal(size=(S, H, H)))
+        trace['w_1_2'] = rng.normal(size=(S, *bes, H, H))
+    if configs['random_noise'] and configs['hetero_noise']:
+        trace['w_in_1_grp_noise'] = rng.normal(size=(S, F, H))
+        trace['w_in_1_grp_sd_noise'] = np.abs(rng.normal(size=(S, F, H)))
+        trace['w_in_1_noise'] = rng.normal(size=(S, *bes, F, H))
+        trace['w_2_out_grp_noise'] = rng.normal(size=(S, H))
+        trace['w_2_out_grp_sd_noise'] = np.abs(rng.normal(size=(S, H)))
+        trace['w_2_out_noise'] = rng.normal(size=(S, *bes, H))
+        if configs['nn_hidden_layers_num'] == 2:
+            trace['w_1_2_grp_noise'] = rng.normal(size=(S, H, H))
+            trace['w_1_2_grp_sd_noise'] = np.abs(rng.normal(size=(S, H, H)))
+            trace['w_1_2_noise'] = rng.normal(size=(S, *bes, H, H))
+    elif configs['random_noise']:
+        trace['sigma_noise'] = np.abs(rng.normal(size=(S, *bes)))
+    else:
+        trace['sigma_noise'] = np.abs(rng.normal(size=(S,)))
+    return trace
+
+
+def naive_nn_hbr_moments(X, batch_effects, configs, trace):
+    """ per-sample, per-subject reference evaluation of the nn networks """
+
+    def expit(x):
+        return 1. / (1. + np.exp(-x))
+
+    n_layers = configs['nn_hidden_layers_num']
+    mu = np.zeros((SAMPLE_NUM, N))
+    s2 = np.zeros((SAMPLE_NUM, N))
+    for s in range(SAMPLE_NUM):
+        for n in range(N):
+            be = tuple(int(v) for v in batch_effects[n])
+            w_in_1 = (trace['w_in_1'][s][be] * trace['w_in_1_grp_sd'][s] +
+                      trace['w_in_1_grp'][s])
+            w_2_out = (trace['w_2_out'][s][be] * trace['w_2_out_grp_sd'][s] +
+                       trace['w_2_out_grp'][s])
+            intercept = (trace['mu_prior_intercept'][s] +
+                         trace['intercepts_offset'][s][be] *
+                         trace['sigma_prior_intercept'][s])
+            act = np.tanh(X[n] @ w_in_1)
+            if n_layers == 2:
+                w_1_2 = (trace['w_1_2'][s][be] * trace['w_1_2_grp_sd'][s] +
+                         trace['w_1_2_grp'][s])
+                act = np.tanh(act @ w_1_2)
+            mu[s, n] = intercept + act @ w_2_out
+            if configs['random_noise'] and configs['hetero_noise']:
+                w_in_1_noise = (trace['w_in_1_noise'][s][be] *
+                                trace['w_in_1_grp_sd_noise'][s] +
+                                trace['w_in_1_grp_noise'][s])
+                w_2_out_noise = (trace['w_2_out_noise'][s][be] *
+                                 trace['w_2_out_grp_sd_noise'][s] +
+                                 trace['w_2_out_grp_noise'][s])
+                act_noise = expit(X[n] @ w_in_1_noise)
+                if n_layers == 2:
+                    w_1_2_noise = (trace['w_1_2_noise'][s][be] *
+                                   trace['w_1_2_grp_sd_noise'][s] +
+                                   trace['w_1_2_grp_noise'][s])
+                    act_noise = expit(act_noise @ w_1_2_noise)
+                sigma_y = np.logaddexp(0, act_noise @ w_2_out_noise) + 1e-5
+            elif configs['random_noise']:
+                sigma_y = trace['sigma_noise'][s][be]
+            else:
+                sigma_y = trace['sigma_noise'][s]
+            s2[s, n] = sigma_y ** 2
+    return (mu.mean(axis=0)[:, np.newaxis],
+            (mu.var(axis=0) + s2.mean(axis=0))[:, np.newaxis])
+
+
+def test_nn_hbr_moments():
+    rng = np.random.default_rng(1)
+    X = rng.normal(size=(N, FEATURE_NUM))
+    batch_effects = simulate_batch_effects(rng)
+    for n_layers in (1, 2):
+        for random_noise, hetero_noise in ((True, True), (True, False),
+                                           (False, False)):
+            configs = {'nn_hidden_layers_num': n_layers,
+                       'random_noise': random_noise,
+                       'hetero_noise': hetero_noise}
+            trace = simulate_nn_trace(rng, configs)
+            pred_mean, pred_var = nn_hbr_moments(X, batch_effects, configs,
+                                                 trace)
+            ref_mean, ref_var = naive_nn_hbr_moments(X, batch_effects,
+                                                     configs, trace)
+            assert np.allclose(pred_mean, ref_mean), configs
+            assert np.allclose(pred_var, ref_var), configs
+
+
+def test_ppc_moments():
+    rng = np.random.default_rng(2)
+    like = rng.normal(size=(SAMPLE_NUM, N, RESPONSE_NUM))
+    # ppc_moments may consume its input buffer, so reduce a copy
+    pred_mean, pred_var = ppc_moments(like.copy())
+    assert np.allclose(pred_mean, like.mean(axis=0))
+    assert np.allclose(pred_var, like.var(axis=0))
+
+
+if __name__ == '__main__':
+    test_hbr_moments()
+    test_nn_hbr_moments()
+    test_ppc_moments()
+    print('All moment cross-checks passed.')